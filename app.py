@@ -4,15 +4,22 @@ Features: Vietnamese PDF, Email sending, Bulk download, Email status tracking
 """
 from flask import Flask, render_template, request, jsonify, send_file, session
 import pandas as pd
+import numpy as np
 import os
 import io
+import re
 import zipfile
 import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email.mime.text import MIMEText
-from email import encoders
+import threading
+import time
+import atexit
+import uuid
+from email.message import EmailMessage
+from xml.sax.saxutils import escape as xml_escape
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -21,11 +28,24 @@ from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph,
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils.exceptions import IllegalCharacterError
+from openpyxl.styles import Font, Alignment, Border, Side, PatternFill, NamedStyle
+from openpyxl.styles.fonts import DEFAULT_FONT
 
 app = Flask(__name__)
 app.secret_key = 'salary_report_secret_key_2024'
 
+# Upload limits: a payroll workbook is far below these, anything bigger would only exhaust memory
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+# Data rows per sheet. A loaded employee row costs about 20 KB (frames, search text and index, prepared
+# slips), so this keeps one upload near 400 MB; a 50 MB workbook could otherwise hold over 100000 rows
+MAX_UPLOAD_ROWS = 20000
+# Title and header rows read on top of MAX_UPLOAD_ROWS, before clean_dataframe drops them
+MAX_UPLOAD_HEADER_ROWS = 20
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
 # Register Vietnamese font for PDF
 FONT_DIR = os.path.join(os.path.dirname(__file__), 'fonts')
 VIETNAMESE_FONT_AVAILABLE = False
@@ -49,16 +69,36 @@ for font_file, font_name in font_options:
     except Exception as e:
         print(f"Could not load font {font_file}: {e}")
 
+# Prefer the Rust-based calamine reader for Excel uploads when it is installed
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_READ_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_READ_ENGINE = None  # Let pandas pick (openpyxl for .xlsx)
+
 # Global storage for uploaded data
 data_store = {
     'thong_tin': None,
+    'name_col': None,  # Employee name column of 'thong_tin', see find_employee_name_column
+    'email_col': None,  # Employee email column of 'thong_tin', see find_employee_email_column
+    'search_text': None,  # Lowercased searchable 'thong_tin' cells joined per row, see build_search_text
+    'search_index': {},  # Trigram -> row positions in 'search_text', see build_search_index
     'luong': None,
+    'luong_name_index': {},  # Normalized employee name -> row position in 'luong'
+    'info_col_map': [],  # Salary slip field -> 'thong_tin' column position, see build_info_column_map
+    'slip_col_map': [],  # Salary slip field -> 'luong' column position, see build_slip_column_map
+    'slips': [],  # Salary slip data per 'thong_tin' row, see build_salary_slips
     'columns_thong_tin': [],
     'columns_luong': [],
     'employees_list': [],
+    'upload_id': None,  # Changes on every upload, used in export ETags
     'email_status': {}  # Track email status per employee: {index: {'sent': bool, 'success': bool, 'message': str, 'time': str}}
 }
 
+# Held while swapping in a new upload and while taking the bulk export snapshot. Request handlers
+# read data_store without it, so one that reads several keys during a swap may mix two uploads
+data_store_lock = threading.Lock()
+
 # Email configuration (can be overridden via environment variables)
 EMAIL_CONFIG = {
     'smtp_server': os.environ.get('SMTP_SERVER', 'smtp.gmail.com'),
@@ -67,6 +107,12 @@ EMAIL_CONFIG = {
     'sender_password': os.environ.get('SENDER_PASSWORD', ''),  # For Gmail, use App Password
 }
 
+SMTP_IDLE_CHECK_SECONDS = 60  # Ping a connection idle for longer than this before reusing it
+
+# SMTP connection kept open across requests, see send_with_smtp_session
+smtp_shared_session = {}
+smtp_shared_lock = threading.Lock()  # Held while a request is sending over smtp_shared_session
+
 # Vietnamese to ASCII mapping for fallback
 VIETNAMESE_MAP = {
     'à': 'a', 'á': 'a', 'ả': 'a', 'ã': 'a', 'ạ': 'a',
@@ -96,34 +142,46 @@ VIETNAMESE_MAP = {
     'Ư': 'U', 'Ừ': 'U', 'Ứ': 'U', 'Ử': 'U', 'Ữ': 'U', 'Ự': 'U',
     'Ỳ': 'Y', 'Ý': 'Y', 'Ỷ': 'Y', 'Ỹ': 'Y', 'Ỵ': 'Y',
 }
+VIETNAMESE_TRANSLATION = str.maketrans(VIETNAMESE_MAP)
+UNSAFE_FILENAME_CHARS = re.compile(r'[^\w ]')
 
 
+@lru_cache(maxsize=2048)
 def remove_accents(text):
     """Convert Vietnamese text to ASCII for PDF fallback"""
-    result = ''
-    for char in str(text):
-        result += VIETNAMESE_MAP.get(char, char)
-    return result
+    return str(text).translate(VIETNAMESE_TRANSLATION)
 
 
+def safe_filename(name):
+    """Keep only letters, digits, spaces and underscores of a name for use in a file name"""
+    # \w is exactly str.isalnum() plus '_', so this matches the old per-character filter
+    return UNSAFE_FILENAME_CHARS.sub('', str(name)).strip()
+
+
+NUMERIC_DIGITS = r'\d(?:_?\d)*'
+NUMERIC_COLUMN_RE = re.compile(
+    rf'[-+]?(?:(?:{NUMERIC_DIGITS}(?:\.(?:{NUMERIC_DIGITS})?)?|\.{NUMERIC_DIGITS})(?:e[-+]?{NUMERIC_DIGITS})?'
+    r'|inf|infinity|nan)',
+    re.IGNORECASE
+)
+
+
+@lru_cache(maxsize=4096)
 def is_valid_column(col_name):
     """Check if column name is valid"""
     col_str = str(col_name).strip()
-    if col_str.startswith('Unnamed') or col_str.startswith('Col_') or col_str.startswith('_'):
+    if not col_str or col_str.startswith(('Unnamed', 'Col_', '_')):
         return False
-    if col_str == 'nan' or col_str == 'NaN' or pd.isna(col_name) or col_str == '':
+    if pd.isna(col_name):
         return False
-    try:
-        float(col_str)
-        return False
-    except:
-        pass
-    return True
+    # Same strings float() accepts, without raising for every real header
+    return not NUMERIC_COLUMN_RE.fullmatch(col_str)
 
 
-def find_column_by_keywords(df, keywords):
-    """Find column in dataframe that contains any of the keywords"""
-    for col in df.columns:
+@lru_cache(maxsize=256)
+def match_column_by_keywords(columns, keywords):
+    """Find the first of the columns whose name contains any of the keywords"""
+    for col in columns:
         col_lower = str(col).lower()
         for keyword in keywords:
             if keyword.lower() in col_lower:
@@ -131,21 +189,21 @@ def find_column_by_keywords(df, keywords):
     return None
 
 
-def get_value_from_df(df, row_data, keywords):
-    """Get value from row data matching column keywords"""
-    col = find_column_by_keywords(df, keywords)
-    if col and col in df.columns:
-        val = row_data[col] if col in row_data.index else None
-        if pd.notna(val):
-            try:
-                return float(val)
-            except:
-                return val
-    return 0
+def find_column_by_keywords(df, keywords):
+    """Find column in dataframe that contains any of the keywords"""
+    # Every upload has the same few headers, so cache the scan per (columns, keywords)
+    return match_column_by_keywords(tuple(df.columns), tuple(keywords))
 
 
+@lru_cache(maxsize=4096, typed=True)
 def format_number(val):
     """Format number with thousand separator"""
+    # Slip amounts are already Python numbers, so format them without the float() round trip
+    if isinstance(val, float):
+        return f"{val:,.0f}".replace(",", ".") if val else ""
+    if isinstance(val, int):
+        return f"{val:,}".replace(",", ".") if val else ""
+    
     if val is None or val == 0:
         return ""
     try:
@@ -157,168 +215,115 @@ def format_number(val):
         return str(val)
 
 
-def clean_dataframe(df, sheet_name):
-    """Clean and process the dataframe from Excel"""
-    if 'thông tin' in sheet_name.lower() or 'thong tin' in sheet_name.lower():
-        # Find header rows
-        header_row = None
-        for i in range(min(5, len(df))):
-            row = df.iloc[i]
-            row_str = str(row.values)
-            if 'Họ tên' in row_str or 'STT' in row_str:
-                header_row = i
-                break
-        
-        if header_row is not None:
-            main_headers = df.iloc[header_row].tolist()
-            sub_headers = df.iloc[header_row + 1].tolist() if header_row + 1 < len(df) else [None] * len(main_headers)
-            
-            combined_headers = []
-            last_valid_main = ''
-            for i, (main, sub) in enumerate(zip(main_headers, sub_headers)):
-                main_str = str(main).strip() if pd.notna(main) and not str(main).startswith('Unnamed') else ''
-                sub_str = str(sub).strip() if pd.notna(sub) and not str(sub).startswith('Unnamed') else ''
-                
-                try:
-                    if main_str and float(main_str):
-                        main_str = ''
-                except:
-                    pass
-                try:
-                    if sub_str and float(sub_str):
-                        sub_str = ''
-                except:
-                    pass
-                
-                if main_str:
-                    last_valid_main = main_str
-                
-                if sub_str and main_str:
-                    combined = f"{main_str} - {sub_str}"
-                elif sub_str:
-                    combined = f"{last_valid_main} - {sub_str}" if last_valid_main else sub_str
-                elif main_str:
-                    combined = main_str
-                else:
-                    combined = f'_Col_{i}'
-                
-                combined_headers.append(combined)
-            
-            data_start = header_row + 2
-            if data_start < len(df):
-                check_row = df.iloc[data_start]
-                first_vals = [str(v) for v in check_row.head(3).values if pd.notna(v)]
-                if first_vals and all(v.replace('.', '').isdigit() for v in first_vals):
-                    data_start += 1
-            
-            df = df.iloc[data_start:]
-            df.columns = combined_headers
-        
-        cols_to_keep = [col for col in df.columns if not str(col).startswith('_')]
-        df = df[cols_to_keep]
-        df = df.dropna(how='all')
-        
-        stt_col = None
-        for col in df.columns:
-            if 'STT' in str(col).upper():
-                stt_col = col
-                break
-        
-        if stt_col:
-            df[stt_col] = pd.to_numeric(df[stt_col], errors='coerce')
-            df = df[df[stt_col].notna() & (df[stt_col] >= 1)]
-        
-        df = df.reset_index(drop=True)
-    
-    elif 'lương' in sheet_name.lower() or 'luong' in sheet_name.lower():
-        header_row = None
-        for i in range(min(5, len(df))):
-            row = df.iloc[i]
-            row_str = str(row.values).upper()
-            if 'HỌ TÊN' in row_str or 'HO TEN' in row_str or 'NHÂN VIÊN' in row_str:
-                header_row = i
-                break
-        
-        if header_row is not None:
-            main_headers = df.iloc[header_row].tolist()
-            sub_headers = df.iloc[header_row + 1].tolist() if header_row + 1 < len(df) else [None] * len(main_headers)
-            
-            combined_headers = []
-            last_valid_main = ''
-            for i, (main, sub) in enumerate(zip(main_headers, sub_headers)):
-                main_str = str(main).strip() if pd.notna(main) and not str(main).startswith('Unnamed') else ''
-                sub_str = str(sub).strip() if pd.notna(sub) and not str(sub).startswith('Unnamed') else ''
-                
-                try:
-                    if main_str and float(main_str):
-                        main_str = ''
-                except:
-                    pass
-                try:
-                    if sub_str and float(sub_str):
-                        sub_str = ''
-                except:
-                    pass
-                
-                if main_str:
-                    last_valid_main = main_str
-                
-                if sub_str and main_str:
-                    combined = f"{main_str} - {sub_str}"
-                elif sub_str:
-                    combined = f"{last_valid_main} - {sub_str}" if last_valid_main else sub_str
-                elif main_str:
-                    combined = main_str
-                else:
-                    combined = f'_Col_{i}'
-                
-                combined_headers.append(combined)
-            
-            data_start = header_row + 2
-            if data_start < len(df):
-                check_row = df.iloc[data_start]
-                first_vals = [str(v) for v in check_row.head(3).values if pd.notna(v)]
-                if first_vals and all(v.replace('.', '').isdigit() for v in first_vals):
-                    data_start += 1
-            
-            df = df.iloc[data_start:]
-            df.columns = combined_headers
+def is_info_sheet(sheet_name):
+    """Check if sheet holds employee information"""
+    return 'thông tin' in sheet_name.lower() or 'thong tin' in sheet_name.lower()
+
+
+def is_salary_sheet(sheet_name):
+    """Check if sheet holds salary data"""
+    return 'lương' in sheet_name.lower() or 'luong' in sheet_name.lower()
+
+
+def clean_header_cells(values):
+    """Header cells as stripped strings, blanking empty, 'Unnamed' and non-zero numeric cells"""
+    cells = pd.Series(values, dtype=object)
+    text = cells.astype(str).str.strip()
+    numbers = pd.to_numeric(text, errors='coerce')
+    blank = cells.isna() | cells.astype(str).str.startswith('Unnamed') | (numbers.notna() & (numbers != 0))
+    return text.mask(blank, '')
+
+
+def find_header_row(df, keywords, uppercase=False):
+    """Find the header row among the first rows of a sheet"""
+    cells = df.head(5).astype(str)
+    if uppercase:
+        cells = cells.apply(lambda col: col.str.upper())
+    
+    pattern = '|'.join(re.escape(keyword) for keyword in keywords)
+    found = cells.apply(lambda col: col.str.contains(pattern, regex=True)).any(axis=1)
+    return int(found.to_numpy().argmax()) if found.any() else None
+
+
+def compact_dataframe(df):
+    """Store repetitive text columns (bank, position, status...) as categoricals"""
+    for pos in range(df.shape[1]):
+        col = df.iloc[:, pos]
+        # Only all-text columns: categories mixing numbers or dates would be coerced
+        # (ints to floats, datetimes losing their time) and display differently
+        if (col.dtype == object and col.nunique() < len(df) * 0.5
+                and pd.api.types.infer_dtype(col, skipna=True) == 'string'):
+            df.isetitem(pos, col.astype('category'))
+    return df
+
+
+def clean_sheet(df, header_keywords, uppercase=False):
+    """Merge the two header rows of a sheet into column names and keep only employee rows"""
+    header_row = find_header_row(df, header_keywords, uppercase)
+    
+    if header_row is not None:
+        main_headers = df.iloc[header_row].tolist()
+        sub_headers = df.iloc[header_row + 1].tolist() if header_row + 1 < len(df) else [None] * len(main_headers)
         
-        cols_to_keep = [col for col in df.columns if not str(col).startswith('_')]
-        df = df[cols_to_keep]
-        df = df.dropna(how='all')
+        main = clean_header_cells(main_headers)
+        sub = clean_header_cells(sub_headers)
+        # Each non-empty main header starts a group; its cells carry that header forward
+        last_valid_main = main.groupby((main != '').cumsum()).transform('first')
+        col_ids = pd.Series(range(len(main))).astype(str)
         
-        stt_col = None
-        for col in df.columns:
-            if 'STT' in str(col).upper():
-                stt_col = col
-                break
+        combined_headers = np.where(
+            sub != '',
+            np.where(main != '', main + ' - ' + sub,
+                     np.where(last_valid_main != '', last_valid_main + ' - ' + sub, sub)),
+            np.where(main != '', main, '_Col_' + col_ids)
+        ).tolist()
         
-        if stt_col:
-            df[stt_col] = pd.to_numeric(df[stt_col], errors='coerce')
-            df = df[df[stt_col].notna() & (df[stt_col] >= 1)]
+        data_start = header_row + 2
+        if data_start < len(df):
+            check_row = df.iloc[data_start]
+            first_vals = [str(v) for v in check_row.head(3).values if pd.notna(v)]
+            if first_vals and all(v.replace('.', '').isdigit() for v in first_vals):
+                data_start += 1
         
-        df = df.reset_index(drop=True)
+        df = df.iloc[data_start:]
+        df.columns = combined_headers
     
+    cols_to_keep = [col for col in df.columns if not str(col).startswith('_')]
+    df = df[cols_to_keep]
+    df = df.dropna(how='all')
+    
+    stt_col = None
+    for col in df.columns:
+        if 'STT' in str(col).upper():
+            stt_col = col
+            break
+    
+    if stt_col:
+        df[stt_col] = pd.to_numeric(df[stt_col], errors='coerce')
+        df = df[df[stt_col].notna() & (df[stt_col] >= 1)]
+    
+    df = df.reset_index(drop=True)
+    
+    return compact_dataframe(df)
+
+
+def clean_dataframe(df, sheet_name):
+    """Clean and process the dataframe from Excel"""
+    if is_info_sheet(sheet_name):
+        return clean_sheet(df, ('Họ tên', 'STT'))
+    elif is_salary_sheet(sheet_name):
+        return clean_sheet(df, ('HỌ TÊN', 'HO TEN', 'NHÂN VIÊN'), uppercase=True)
     return df
 
 
 def find_employee_name_column(df):
     """Find the column that contains employee names"""
-    for col in df.columns:
-        col_lower = str(col).lower()
-        if 'họ tên' in col_lower or 'ho ten' in col_lower or 'tên nhân viên' in col_lower:
-            return col
-    return None
+    return find_column_by_keywords(df, ('họ tên', 'ho ten', 'tên nhân viên'))
 
 
 def find_employee_email_column(df):
     """Find the column that contains employee email"""
-    for col in df.columns:
-        col_lower = str(col).lower()
-        if 'email' in col_lower or 'mail' in col_lower or 'e-mail' in col_lower:
-            return col
-    return None
+    return find_column_by_keywords(df, ('email', 'mail', 'e-mail'))
 
 
 def get_employees_list(df):
@@ -329,23 +334,138 @@ def get_employees_list(df):
     if name_col is None:
         return []
     
+    names = df[name_col].dropna().astype(str).str.strip()
+    names = names[names != '']
+
+    emails = {}
+    if email_col:
+        email_values = df[email_col].dropna().astype(str)
+        email_values = email_values[email_values.str.contains('@', regex=False)].str.strip()
+        emails = dict(zip(email_values.index.to_numpy(), email_values.to_numpy()))
+
     employees = []
-    for idx, row in df.iterrows():
-        name = row[name_col]
-        email = row[email_col] if email_col and email_col in row.index else None
-        if pd.notna(name) and str(name).strip():
-            emp_data = {
-                'index': int(idx),
-                'name': str(name).strip()
-            }
-            if email and pd.notna(email) and '@' in str(email):
-                emp_data['email'] = str(email).strip()
-            employees.append(emp_data)
+    for idx, name in zip(names.index.to_numpy(), names.to_numpy()):
+        emp_data = {
+            'index': int(idx),
+            'name': name
+        }
+        if idx in emails:
+            emp_data['email'] = emails[idx]
+        employees.append(emp_data)
     return employees
 
 
-def get_salary_slip_data(employee_info, salary_data, df_info, df_luong):
-    """Extract salary slip data from employee info and salary data"""
+def row_to_dict(row, columns):
+    """Convert the non-empty values of a row in the given columns to a dict of strings"""
+    return row[columns].dropna().astype(str).to_dict()
+
+
+SEARCH_TEXT_SEPARATOR = '\x1f'  # ASCII unit separator: not in cells or typed search terms, so matches never span two cells
+
+
+def build_search_text(df, columns):
+    """Join the lowercased text of each row's searchable cells into one string per row"""
+    lowered = [values.str.lower() for _, values in df[columns].astype(str).items()]
+    if not lowered:
+        return pd.Series('', index=df.index)
+    return lowered[0].str.cat(lowered[1:], sep=SEARCH_TEXT_SEPARATOR)
+
+
+EMPTY_POSTINGS = np.empty(0, dtype=np.int32)
+
+
+def build_search_index(search_text):
+    """Map every 3-character substring of the lowercased cells to the sorted row positions containing it"""
+    # Posting lists are int32 slices of one shared array (4 bytes per row and trigram) rather than
+    # Python sets, whose per-entry overhead made the index cost several KB per row
+    trigram_ids = {}
+    ids = array('i')
+    positions = array('i')
+    for pos, text in enumerate(search_text.to_numpy()):
+        row_trigrams = {cell[i:i + 3] for cell in text.split(SEARCH_TEXT_SEPARATOR) for i in range(len(cell) - 2)}
+        ids.extend(trigram_ids.setdefault(trigram, len(trigram_ids)) for trigram in row_trigrams)
+        positions.extend([pos] * len(row_trigrams))
+    
+    # Rows were visited in order, so a stable sort by trigram leaves each posting list sorted
+    order = np.argsort(np.frombuffer(ids, dtype=np.int32), kind='stable')
+    postings = np.frombuffer(positions, dtype=np.int32)[order]
+    ends = np.cumsum(np.bincount(np.frombuffer(ids, dtype=np.int32), minlength=len(trigram_ids)))
+    return dict(zip(trigram_ids, np.split(postings, ends[:-1])))
+
+
+def build_salary_name_index(df_luong):
+    """Map normalized employee names to their first row position in the salary sheet"""
+    luong_name_col = find_employee_name_column(df_luong)
+    if luong_name_col is None:
+        return {}
+    
+    keys = df_luong[luong_name_col].astype(str).str.lower().str.strip()
+    keys = keys[~keys.duplicated()]
+    return dict(zip(keys.to_numpy(), keys.index.to_numpy()))
+
+
+def find_salary_row(employee_name):
+    """Get the salary row matching an employee name, or None"""
+    df_luong = data_store['luong']
+    if df_luong is None:
+        return None
+    
+    idx = data_store['luong_name_index'].get(str(employee_name).lower().strip())
+    return df_luong.iloc[idx] if idx is not None else None
+
+
+def build_info_column_map(df_info):
+    """Resolve which employee info columns feed the bank fields of a salary slip"""
+    # (field, column position, only_if_empty) in sheet order, so later columns still win
+    col_map = []
+    for pos, col in enumerate(df_info.columns):
+        col_lower = str(col).lower()
+        
+        if 'số tài khoản' in col_lower and 'ngân hàng' in col_lower:
+            col_map.append(('so_tai_khoan', pos, False))
+        elif 'số tài khoản' in col_lower:
+            col_map.append(('so_tai_khoan', pos, True))
+        
+        if 'tại ngân hàng' in col_lower or ('ngân hàng' in col_lower and 'chi nhánh' in col_lower):
+            col_map.append(('ten_ngan_hang', pos, False))
+        elif 'ngân hàng' in col_lower and 'số' not in col_lower:
+            col_map.append(('ten_ngan_hang', pos, True))
+    
+    return col_map
+
+
+def build_slip_column_map(df_luong):
+    """Resolve which salary sheet columns feed each salary slip field"""
+    # (field, column position, only_if_zero) in sheet order, so later columns still win
+    col_map = []
+    for pos, col in enumerate(df_luong.columns):
+        col_lower = str(col).lower()
+        
+        if ('thuế tncn' in col_lower and 'tổng thu nhập' in col_lower and 
+            'chưa' not in col_lower and 'chịu' not in col_lower and 
+            'tính' not in col_lower and 'bao gồm' not in col_lower):
+            col_map.append(('luong_thoa_thuan', pos, False))
+            col_map.append(('luong_thuc_te', pos, False))
+        
+        if 'lương cơ bản' in col_lower:
+            col_map.append(('luong_dong', pos, False))
+        
+        if ('người lao động phải nộp' in col_lower or 'nld phải nộp' in col_lower) and 'tổng cộng' in col_lower:
+            col_map.append(('bhxh', pos, False))
+        
+        if 'kinh phí công đoàn' in col_lower and 'phí đoàn viên' in col_lower:
+            col_map.append(('doan_phi', pos, False))
+        elif 'phí đoàn viên' in col_lower:
+            col_map.append(('doan_phi', pos, True))
+        
+        if 'thuế tncn phải nộp' in col_lower and 'tr' not in col_lower and '%' not in col_lower:
+            col_map.append(('thue_tncn', pos, False))
+    
+    return col_map
+
+
+def get_salary_slip_data(employee_info, salary_data, name_pos, info_col_map, slip_col_map):
+    """Extract salary slip data from an employee info row and salary row (positional sequences)"""
     data = {
         'ho_ten': '',
         'luong_thoa_thuan': 0,
@@ -358,58 +478,24 @@ def get_salary_slip_data(employee_info, salary_data, df_info, df_luong):
         'thue_tncn': 0,
     }
     
-    name_col = find_employee_name_column(df_info)
-    if name_col and name_col in employee_info.index:
-        val = employee_info[name_col]
+    if name_pos is not None:
+        val = employee_info[name_pos]
         if pd.notna(val):
             data['ho_ten'] = str(val)
     
-    for col in employee_info.index:
-        val = employee_info[col]
-        col_lower = str(col).lower()
-        if pd.notna(val):
-            if 'số tài khoản' in col_lower and 'ngân hàng' in col_lower:
-                data['so_tai_khoan'] = str(val)
-            elif 'số tài khoản' in col_lower and not data['so_tai_khoan']:
-                data['so_tai_khoan'] = str(val)
-            
-            if 'tại ngân hàng' in col_lower or ('ngân hàng' in col_lower and 'chi nhánh' in col_lower):
-                data['ten_ngan_hang'] = str(val)
-            elif 'ngân hàng' in col_lower and 'số' not in col_lower and not data['ten_ngan_hang']:
-                data['ten_ngan_hang'] = str(val)
+    for field, pos, only_if_empty in info_col_map:
+        val = employee_info[pos]
+        if pd.notna(val) and not (only_if_empty and data[field]):
+            data[field] = str(val)
     
     if salary_data is not None:
-        for col in salary_data.index:
-            val = salary_data[col]
-            col_str = str(col)
-            col_lower = col_str.lower()
-            if pd.notna(val):
+        for field, pos, only_if_zero in slip_col_map:
+            val = salary_data[pos]
+            if pd.notna(val) and not (only_if_zero and data[field] != 0):
                 try:
-                    num_val = float(val)
+                    data[field] = float(val)
                 except:
-                    num_val = 0
-                
-                if ('thuế tncn' in col_lower and 'tổng thu nhập' in col_lower and 
-                    'chưa' not in col_lower and 'chịu' not in col_lower and 
-                    'tính' not in col_lower and 'bao gồm' not in col_lower):
-                    data['luong_thoa_thuan'] = num_val
-                    data['luong_thuc_te'] = num_val
-                
-                if 'lương cơ bản' in col_lower:
-                    data['luong_dong'] = num_val
-                
-                if 'người lao động phải nộp' in col_lower and 'tổng cộng' in col_lower:
-                    data['bhxh'] = num_val
-                elif 'nld phải nộp' in col_lower and 'tổng cộng' in col_lower:
-                    data['bhxh'] = num_val
-                
-                if 'kinh phí công đoàn' in col_lower and 'phí đoàn viên' in col_lower:
-                    data['doan_phi'] = num_val
-                elif 'phí đoàn viên' in col_lower and data['doan_phi'] == 0:
-                    data['doan_phi'] = num_val
-                
-                if 'thuế tncn phải nộp' in col_lower and 'tr' not in col_lower and '%' not in col_lower:
-                    data['thue_tncn'] = num_val
+                    data[field] = 0
     
     data['tong_khoan_tru'] = data['bhxh'] + data['doan_phi'] + data['thue_tncn']
     data['tong_thu_nhap'] = data['luong_thuc_te']
@@ -418,43 +504,85 @@ def get_salary_slip_data(employee_info, salary_data, df_info, df_luong):
     return data
 
 
-def generate_excel_salary_slip(employee_index, month, year):
-    """Generate Excel salary slip and return as bytes"""
-    df_info = data_store['thong_tin']
-    df_luong = data_store['luong']
-    
-    if employee_index >= len(df_info):
-        return None, None
-    
-    employee = df_info.iloc[employee_index]
+def build_salary_slips(df_info, df_luong, info_col_map, slip_col_map, luong_name_index):
+    """Compute the salary slip data of every employee, in 'thong_tin' row order"""
     name_col = find_employee_name_column(df_info)
-    employee_name = employee[name_col] if name_col else f'NhanVien_{employee_index}'
-    
-    salary_row = None
-    if df_luong is not None and name_col:
-        luong_name_col = find_employee_name_column(df_luong)
-        if luong_name_col:
-            salary_match = df_luong[df_luong[luong_name_col].astype(str).str.lower().str.strip() == str(employee_name).lower().strip()]
-            if len(salary_match) > 0:
-                salary_row = salary_match.iloc[0]
-    
-    slip_data = get_salary_slip_data(employee, salary_row, df_info, df_luong)
-    
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Phiếu Lương"
-    
-    title_font = Font(bold=True, size=16, color="FF0000")
-    header_font = Font(bold=True, size=11)
-    border = Border(
-        left=Side(style='thin'), right=Side(style='thin'),
-        top=Side(style='thin'), bottom=Side(style='thin')
-    )
-    yellow_fill = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
-    light_yellow_fill = PatternFill(start_color="FFFFCC", end_color="FFFFCC", fill_type="solid")
-    orange_fill = PatternFill(start_color="FFC000", end_color="FFC000", fill_type="solid")
-    light_blue_fill = PatternFill(start_color="DAEEF3", end_color="DAEEF3", fill_type="solid")
-    light_green_fill = PatternFill(start_color="E2EFDA", end_color="E2EFDA", fill_type="solid")
+    name_pos = list(df_info.columns).index(name_col) if name_col else None
+    luong_rows = list(df_luong.itertuples(index=False, name=None)) if df_luong is not None else []
+    
+    slips = []
+    for employee_index, employee_info in enumerate(df_info.itertuples(index=False, name=None)):
+        salary_data = None
+        if name_pos is not None and luong_rows:
+            idx = luong_name_index.get(str(employee_info[name_pos]).lower().strip())
+            salary_data = luong_rows[idx] if idx is not None else None
+        slip_data = get_salary_slip_data(employee_info, salary_data, name_pos, info_col_map, slip_col_map)
+        
+        # File name part for the exported slip, so the generators need nothing but this dict
+        employee_name = employee_info[name_pos] if name_pos is not None else f'NhanVien_{employee_index}'
+        slip_data['ten_file'] = safe_filename(employee_name)
+        slips.append(slip_data)
+    return slips
+
+
+# Shared styles for Excel salary slips
+EXCEL_TITLE_FONT = Font(bold=True, size=16, color="FF0000")
+EXCEL_HEADER_FONT = Font(bold=True, size=11)
+EXCEL_NET_FONT = Font(bold=True, size=12, color="FF0000")
+EXCEL_NOTE_FONT = Font(size=9, italic=True)
+EXCEL_BORDER = Border(
+    left=Side(style='thin'), right=Side(style='thin'),
+    top=Side(style='thin'), bottom=Side(style='thin')
+)
+EXCEL_CENTER = Alignment(horizontal='center')
+EXCEL_YELLOW_FILL = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
+EXCEL_LIGHT_YELLOW_FILL = PatternFill(start_color="FFFFCC", end_color="FFFFCC", fill_type="solid")
+EXCEL_ORANGE_FILL = PatternFill(start_color="FFC000", end_color="FFC000", fill_type="solid")
+EXCEL_LIGHT_BLUE_FILL = PatternFill(start_color="DAEEF3", end_color="DAEEF3", fill_type="solid")
+EXCEL_LIGHT_GREEN_FILL = PatternFill(start_color="E2EFDA", end_color="E2EFDA", fill_type="solid")
+
+
+def make_named_styles(wb):
+    """Register the salary slip cell styles on a workbook"""
+    named_styles = [
+        NamedStyle(name='slip_title', font=EXCEL_TITLE_FONT, alignment=EXCEL_CENTER),
+        NamedStyle(name='slip_label', font=EXCEL_HEADER_FONT, fill=EXCEL_YELLOW_FILL, border=EXCEL_BORDER),
+        NamedStyle(name='slip_value', font=DEFAULT_FONT, border=EXCEL_BORDER),
+        NamedStyle(name='slip_header', font=EXCEL_HEADER_FONT, fill=EXCEL_ORANGE_FILL, border=EXCEL_BORDER, alignment=EXCEL_CENTER),
+        NamedStyle(name='slip_stt', font=DEFAULT_FONT, fill=EXCEL_LIGHT_BLUE_FILL, border=EXCEL_BORDER, alignment=EXCEL_CENTER),
+        NamedStyle(name='slip_item', font=DEFAULT_FONT, fill=EXCEL_LIGHT_BLUE_FILL, border=EXCEL_BORDER),
+        NamedStyle(name='slip_amount', font=DEFAULT_FONT, fill=EXCEL_LIGHT_GREEN_FILL, border=EXCEL_BORDER),
+        NamedStyle(name='slip_total', font=DEFAULT_FONT, fill=EXCEL_LIGHT_YELLOW_FILL, border=EXCEL_BORDER),
+        NamedStyle(name='slip_net_label', font=EXCEL_NET_FONT, fill=EXCEL_YELLOW_FILL, border=EXCEL_BORDER, alignment=EXCEL_CENTER),
+        NamedStyle(name='slip_net_amount', font=EXCEL_NET_FONT, fill=EXCEL_LIGHT_YELLOW_FILL, border=EXCEL_BORDER),
+        NamedStyle(name='slip_note', font=EXCEL_NOTE_FONT),
+    ]
+    for named_style in named_styles:
+        wb.add_named_style(named_style)
+
+
+def excel_cell(ws, value=None, style=None):
+    """Create a cell for a write-only worksheet, optionally with a named style"""
+    cell = WriteOnlyCell(ws, value=value)
+    if style is not None:
+        cell.style = style
+    return cell
+
+
+EXCEL_SLIP_AMOUNT_FIELDS = (
+    'luong_thoa_thuan', 'luong_dong', 'luong_thuc_te', 'bhxh', 'doan_phi', 'thue_tncn',
+    'tong_thu_nhap', 'tong_khoan_tru', 'luong_thuc_nhan',
+)
+EXCEL_SLIP_FIELDS = ('tieu_de', 'ho_ten', 'so_tai_khoan', 'ten_ngan_hang') + EXCEL_SLIP_AMOUNT_FIELDS
+EXCEL_SLIP_SHEET = 'xl/worksheets/sheet1.xml'
+EXCEL_SLIP_PLACEHOLDER = re.compile(r'<c ([^>]*)><is><t>\{(\w+)\}</t></is></c>')
+
+
+def build_excel_salary_slip(values):
+    """Build the Excel salary slip workbook from its display values and return as bytes"""
+    wb = Workbook(write_only=True)
+    make_named_styles(wb)
+    ws = wb.create_sheet("Phiếu Lương")
     
     ws.column_dimensions['A'].width = 8
     ws.column_dimensions['B'].width = 20
@@ -462,377 +590,541 @@ def generate_excel_salary_slip(employee_index, month, year):
     ws.column_dimensions['D'].width = 25
     ws.column_dimensions['E'].width = 25
     
-    ws.merge_cells('A1:E1')
-    ws['A1'] = f"PHIẾU LƯƠNG THÁNG {month} NĂM {year}"
-    ws['A1'].font = title_font
-    ws['A1'].alignment = Alignment(horizontal='center')
+    # Write-only sheets are streamed top to bottom, so rows are appended in order
+    # and merged ranges are registered by row number as we go
+    row = 1
+    ws.append([excel_cell(ws, values['tieu_de'], style='slip_title')])
+    ws.merged_cells.add('A1:E1')
+    
+    row += 1
+    ws.append([])
     
-    row = 3
     info_rows = [
-        ('Họ tên:', slip_data['ho_ten'], 'Ngày công chuẩn:', ''),
-        ('Lương thỏa thuận:', format_number(slip_data['luong_thoa_thuan']), 'Ngày công thực tế:', ''),
+        ('Họ tên:', values['ho_ten'], 'Ngày công chuẩn:', ''),
+        ('Lương thỏa thuận:', values['luong_thoa_thuan'], 'Ngày công thực tế:', ''),
         ('% Lương Thử việc:', '', 'Nghỉ phép:', ''),
-        ('Lương đóng:', format_number(slip_data['luong_dong']), 'Tổng giờ tăng ca:', ''),
-        ('Số tài khoản:', slip_data['so_tai_khoan'], 'Tên ngân hàng:', slip_data['ten_ngan_hang']),
+        ('Lương đóng:', values['luong_dong'], 'Tổng giờ tăng ca:', ''),
+        ('Số tài khoản:', values['so_tai_khoan'], 'Tên ngân hàng:', values['ten_ngan_hang']),
     ]
     
     for info in info_rows:
-        ws[f'A{row}'] = info[0]
-        ws[f'A{row}'].font = header_font
-        ws[f'A{row}'].fill = yellow_fill
-        ws[f'A{row}'].border = border
-        
-        ws[f'B{row}'] = info[1]
-        ws[f'B{row}'].border = border
-        
-        ws[f'C{row}'] = info[2]
-        ws[f'C{row}'].font = header_font
-        ws[f'C{row}'].fill = yellow_fill
-        ws[f'C{row}'].border = border
-        
-        ws.merge_cells(f'D{row}:E{row}')
-        ws[f'D{row}'] = info[3]
-        ws[f'D{row}'].border = border
-        ws[f'E{row}'].border = border
-        
         row += 1
+        ws.append([
+            excel_cell(ws, info[0], style='slip_label'),
+            excel_cell(ws, info[1], style='slip_value'),
+            excel_cell(ws, info[2], style='slip_label'),
+            excel_cell(ws, info[3], style='slip_value'),
+            excel_cell(ws, style='slip_value'),
+        ])
+        ws.merged_cells.add(f'D{row}:E{row}')
     
     row += 1
-    ws[f'A{row}'] = 'STT'
-    ws[f'A{row}'].font = header_font
-    ws[f'A{row}'].fill = orange_fill
-    ws[f'A{row}'].border = border
-    ws[f'A{row}'].alignment = Alignment(horizontal='center')
-    
-    ws.merge_cells(f'B{row}:C{row}')
-    ws[f'B{row}'] = 'Các Khoản Thu Nhập'
-    ws[f'B{row}'].font = header_font
-    ws[f'B{row}'].fill = orange_fill
-    ws[f'B{row}'].border = border
-    ws[f'B{row}'].alignment = Alignment(horizontal='center')
-    ws[f'C{row}'].border = border
-    
-    ws.merge_cells(f'D{row}:E{row}')
-    ws[f'D{row}'] = 'Các Khoản Trừ Vào Lương'
-    ws[f'D{row}'].font = header_font
-    ws[f'D{row}'].fill = orange_fill
-    ws[f'D{row}'].border = border
-    ws[f'D{row}'].alignment = Alignment(horizontal='center')
-    ws[f'E{row}'].border = border
+    ws.append([])
+    
+    row += 1
+    ws.append([
+        excel_cell(ws, 'STT', style='slip_header'),
+        excel_cell(ws, 'Các Khoản Thu Nhập', style='slip_header'),
+        excel_cell(ws, style='slip_value'),
+        excel_cell(ws, 'Các Khoản Trừ Vào Lương', style='slip_header'),
+        excel_cell(ws, style='slip_value'),
+    ])
+    ws.merged_cells.add(f'B{row}:C{row}')
+    ws.merged_cells.add(f'D{row}:E{row}')
     
     table_data = [
-        ('1', 'Lương thực tế', format_number(slip_data['luong_thuc_te']), 'BHXH', format_number(slip_data['bhxh'])),
-        ('2', 'Phép năm', '', 'Đoàn phí', format_number(slip_data['doan_phi'])),
-        ('3', 'Lương tăng ca', '', 'Thuế Thu Nhập Cá Nhân', format_number(slip_data['thue_tncn'])),
+        ('1', 'Lương thực tế', values['luong_thuc_te'], 'BHXH', values['bhxh']),
+        ('2', 'Phép năm', '', 'Đoàn phí', values['doan_phi']),
+        ('3', 'Lương tăng ca', '', 'Thuế Thu Nhập Cá Nhân', values['thue_tncn']),
         ('4', 'Lương bổ sung', '', 'Tạm Ứng', ''),
         ('5', 'Giữ xe', '', 'Tiền phạt', ''),
         ('6', 'Công tác phí', '', 'Khác', ''),
     ]
     
-    row += 1
     for data_row in table_data:
-        ws[f'A{row}'] = data_row[0]
-        ws[f'A{row}'].border = border
-        ws[f'A{row}'].alignment = Alignment(horizontal='center')
-        ws[f'A{row}'].fill = light_blue_fill
-        
-        ws[f'B{row}'] = data_row[1]
-        ws[f'B{row}'].border = border
-        ws[f'B{row}'].fill = light_blue_fill
-        
-        ws[f'C{row}'] = data_row[2]
-        ws[f'C{row}'].border = border
-        ws[f'C{row}'].fill = light_green_fill
-        
-        ws[f'D{row}'] = data_row[3]
-        ws[f'D{row}'].border = border
-        ws[f'D{row}'].fill = light_blue_fill
-        
-        ws[f'E{row}'] = data_row[4]
-        ws[f'E{row}'].border = border
-        ws[f'E{row}'].fill = light_green_fill
-        
         row += 1
-    
-    ws[f'A{row}'] = ''
-    ws[f'A{row}'].border = border
-    
-    ws[f'B{row}'] = 'Tổng Cộng Thu Nhập'
-    ws[f'B{row}'].font = header_font
-    ws[f'B{row}'].border = border
-    ws[f'B{row}'].fill = yellow_fill
-    
-    ws[f'C{row}'] = format_number(slip_data['tong_thu_nhap'])
-    ws[f'C{row}'].border = border
-    ws[f'C{row}'].fill = light_yellow_fill
-    
-    ws[f'D{row}'] = 'Tổng Cộng Khoản Trừ'
-    ws[f'D{row}'].font = header_font
-    ws[f'D{row}'].border = border
-    ws[f'D{row}'].fill = yellow_fill
-    
-    ws[f'E{row}'] = format_number(slip_data['tong_khoan_tru'])
-    ws[f'E{row}'].border = border
-    ws[f'E{row}'].fill = light_yellow_fill
+        ws.append([
+            excel_cell(ws, data_row[0], style='slip_stt'),
+            excel_cell(ws, data_row[1], style='slip_item'),
+            excel_cell(ws, data_row[2], style='slip_amount'),
+            excel_cell(ws, data_row[3], style='slip_item'),
+            excel_cell(ws, data_row[4], style='slip_amount'),
+        ])
     
     row += 1
-    ws.merge_cells(f'A{row}:D{row}')
-    ws[f'A{row}'] = 'Tổng Số Tiền Lương Thực Nhận'
-    ws[f'A{row}'].font = Font(bold=True, size=12, color="FF0000")
-    ws[f'A{row}'].border = border
-    ws[f'A{row}'].fill = yellow_fill
-    ws[f'A{row}'].alignment = Alignment(horizontal='center')
-    ws[f'B{row}'].border = border
-    ws[f'C{row}'].border = border
-    ws[f'D{row}'].border = border
-    
-    ws[f'E{row}'] = format_number(slip_data['luong_thuc_nhan'])
-    ws[f'E{row}'].font = Font(bold=True, size=12, color="FF0000")
-    ws[f'E{row}'].border = border
-    ws[f'E{row}'].fill = light_yellow_fill
-    
-    row += 2
-    ws.merge_cells(f'A{row}:E{row}')
-    ws[f'A{row}'] = "Anh/Chị vui lòng kiểm tra lại thông tin trên phiếu lương. Mọi thắc mắc vui lòng liên hệ Phòng HCNS trong vòng"
-    ws[f'A{row}'].font = Font(size=9, italic=True)
+    ws.append([
+        excel_cell(ws, '', style='slip_value'),
+        excel_cell(ws, 'Tổng Cộng Thu Nhập', style='slip_label'),
+        excel_cell(ws, values['tong_thu_nhap'], style='slip_total'),
+        excel_cell(ws, 'Tổng Cộng Khoản Trừ', style='slip_label'),
+        excel_cell(ws, values['tong_khoan_tru'], style='slip_total'),
+    ])
     
     row += 1
-    ws.merge_cells(f'A{row}:E{row}')
-    ws[f'A{row}'] = "24 giờ (kể từ thời điểm nhận được thông báo này) để được giải quyết."
-    ws[f'A{row}'].font = Font(size=9, italic=True)
+    ws.append([
+        excel_cell(ws, 'Tổng Số Tiền Lương Thực Nhận', style='slip_net_label'),
+        excel_cell(ws, style='slip_value'),
+        excel_cell(ws, style='slip_value'),
+        excel_cell(ws, style='slip_value'),
+        excel_cell(ws, values['luong_thuc_nhan'], style='slip_net_amount'),
+    ])
+    ws.merged_cells.add(f'A{row}:D{row}')
     
     row += 1
-    ws.merge_cells(f'A{row}:E{row}')
-    ws[f'A{row}'] = "Quá thời hạn trên, thông tin trên phiếu lương sẽ được xem là chính xác và không có khiếu nại. Trân trọng cảm ơn!"
-    ws[f'A{row}'].font = Font(size=9, italic=True)
+    ws.append([])
+    
+    notes = [
+        "Anh/Chị vui lòng kiểm tra lại thông tin trên phiếu lương. Mọi thắc mắc vui lòng liên hệ Phòng HCNS trong vòng",
+        "24 giờ (kể từ thời điểm nhận được thông báo này) để được giải quyết.",
+        "Quá thời hạn trên, thông tin trên phiếu lương sẽ được xem là chính xác và không có khiếu nại. Trân trọng cảm ơn!",
+    ]
+    for note in notes:
+        row += 1
+        ws.append([excel_cell(ws, note, style='slip_note')])
+        ws.merged_cells.add(f'A{row}:E{row}')
     
     output = io.BytesIO()
     wb.save(output)
-    output.seek(0)
+    return output.getvalue()
+
+
+@lru_cache(maxsize=1)
+def excel_slip_template():
+    """Build the Excel salary slip once with placeholder values and return its zip entries"""
+    template = build_excel_salary_slip({field: f'{{{field}}}' for field in EXCEL_SLIP_FIELDS})
+    with zipfile.ZipFile(io.BytesIO(template)) as zf:
+        return tuple((info, zf.read(info)) for info in zf.infolist())
+
+
+def excel_slip_cell(match, values):
+    """Render one placeholder cell of the Excel slip template, written the way openpyxl would"""
+    attributes, field = match.groups()
+    value = values[field]
+    if value == '':
+        return f'<c {attributes} />'
+    if ILLEGAL_CHARACTERS_RE.search(value):
+        raise IllegalCharacterError(f"{value} cannot be used in worksheets.")
+    space = ' xml:space="preserve"' if value.strip() and value != value.strip() else ''
+    return f'<c {attributes}><is><t{space}>{xml_escape(value)}</t></is></c>'
+
+
+def render_excel_salary_slip(values):
+    """Fill the cached Excel salary slip template with the display values and return as bytes"""
+    # The layout and styles never change, so only the sheet XML is patched and the rest is copied as is.
+    # The fastest deflate level gets nearly all of the size reduction (~26 KB -> ~7 KB per slip),
+    # which matters for email attachments, at a fraction of a millisecond per slip
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        for info, content in excel_slip_template():
+            if info.filename == EXCEL_SLIP_SHEET:
+                sheet_xml = content.decode('utf-8')
+                content = EXCEL_SLIP_PLACEHOLDER.sub(lambda m: excel_slip_cell(m, values), sheet_xml).encode('utf-8')
+            zf.writestr(info.filename, content)
+    return output.getvalue()
+
+
+def generate_excel_salary_slip(employee_index, month, year, slips=None):
+    """Generate Excel salary slip and return as bytes"""
+    if slips is None:
+        slips = data_store['slips']
     
-    safe_name = "".join(c for c in str(employee_name) if c.isalnum() or c in (' ', '_')).strip()
-    filename = f"PhieuLuong_{safe_name}_Thang{month}_{year}.xlsx"
+    if employee_index >= len(slips):
+        return None, None
+    
+    slip_data = slips[employee_index]
+    
+    values = {
+        'tieu_de': f"PHIẾU LƯƠNG THÁNG {month} NĂM {year}",
+        'ho_ten': slip_data['ho_ten'],
+        'so_tai_khoan': slip_data['so_tai_khoan'],
+        'ten_ngan_hang': slip_data['ten_ngan_hang'],
+    }
+    for field in EXCEL_SLIP_AMOUNT_FIELDS:
+        values[field] = format_number(slip_data[field])
     
-    return output.getvalue(), filename
+    filename = f"PhieuLuong_{slip_data['ten_file']}_Thang{month}_{year}.xlsx"
+    
+    return render_excel_salary_slip(values), filename
+
+
+def pdf_text(text):
+    """Return text for the PDF, without accents when no Vietnamese font is available"""
+    if VIETNAMESE_FONT_AVAILABLE:
+        return str(text)
+    return remove_accents(str(text))
 
 
-def generate_pdf_salary_slip(employee_index, month, year):
+# Static PDF slip texts, converted for the available font once at import
+PDF_INFO_LABELS = [
+    (pdf_text('Họ tên:'), pdf_text('Ngày công chuẩn:')),
+    (pdf_text('Lương thỏa thuận:'), pdf_text('Ngày công thực tế:')),
+    (pdf_text('% Lương Thử việc:'), pdf_text('Nghỉ phép:')),
+    (pdf_text('Lương đóng:'), pdf_text('Tổng giờ tăng ca:')),
+    (pdf_text('Số tài khoản:'), pdf_text('Tên ngân hàng:')),
+]
+PDF_TABLE_HEADER = ('STT', pdf_text('Các Khoản Thu Nhập'), '', pdf_text('Các Khoản Trừ Vào Lương'), '')
+PDF_ITEM_LABELS = [
+    ('1', pdf_text('Lương thực tế'), 'BHXH'),
+    ('2', pdf_text('Phép năm'), pdf_text('Đoàn phí')),
+    ('3', pdf_text('Lương tăng ca'), pdf_text('Thuế Thu Nhập Cá Nhân')),
+    ('4', pdf_text('Lương bổ sung'), pdf_text('Tạm Ứng')),
+    ('5', pdf_text('Giữ xe'), pdf_text('Tiền phạt')),
+    ('6', pdf_text('Công tác phí'), pdf_text('Khác')),
+]
+PDF_TOTAL_INCOME_LABEL = pdf_text('Tổng Cộng Thu Nhập')
+PDF_TOTAL_DEDUCTION_LABEL = pdf_text('Tổng Cộng Khoản Trừ')
+PDF_NET_LABEL = pdf_text('Tổng Số Tiền Lương Thực Nhận')
+PDF_NOTES = [
+    pdf_text("Anh/Chị vui lòng kiểm tra lại thông tin trên phiếu lương. Mọi thắc mắc vui lòng liên hệ Phòng HCNS trong vòng"),
+    pdf_text("24 giờ (kể từ thời điểm nhận được thông báo này) để được giải quyết."),
+    pdf_text("Quá thời hạn trên, thông tin trên phiếu lương sẽ được xem là chính xác và không có khiếu nại. Trân trọng cảm ơn!"),
+]
+
+
+# Shared styles for PDF salary slips
+PDF_FONT_NAME = VIETNAMESE_FONT_NAME if VIETNAMESE_FONT_AVAILABLE else 'Helvetica'
+PDF_SAMPLE_STYLES = getSampleStyleSheet()
+PDF_TITLE_STYLE = ParagraphStyle(
+    'CustomTitle',
+    parent=PDF_SAMPLE_STYLES['Heading1'],
+    fontName=PDF_FONT_NAME,
+    fontSize=16,
+    alignment=1,
+    spaceAfter=20,
+    textColor=colors.red
+)
+PDF_NOTE_STYLE = ParagraphStyle(
+    'CustomNote',
+    parent=PDF_SAMPLE_STYLES['Normal'],
+    fontName=PDF_FONT_NAME,
+    fontSize=8,
+    italic=True
+)
+PDF_INFO_COL_WIDTHS = (3.5*cm, 5*cm, 4*cm, 5*cm)
+PDF_MAIN_COL_WIDTHS = (1.5*cm, 4.5*cm, 3.5*cm, 4.5*cm, 3.5*cm)
+PDF_NET_COL_WIDTHS = (14*cm, 3.5*cm)
+PDF_INFO_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (0, -1), colors.yellow),
+    ('BACKGROUND', (2, 0), (2, -1), colors.yellow),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+    ('FONTNAME', (0, 0), (-1, -1), PDF_FONT_NAME),
+    ('FONTSIZE', (0, 0), (-1, -1), 9),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+])
+PDF_MAIN_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#FFC000')),
+    ('SPAN', (1, 0), (2, 0)),
+    ('SPAN', (3, 0), (4, 0)),
+    ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, -1), PDF_FONT_NAME),
+    ('FONTSIZE', (0, 0), (-1, 0), 10),
+    
+    ('BACKGROUND', (0, 1), (0, -2), colors.HexColor('#DAEEF3')),
+    ('BACKGROUND', (1, 1), (1, -2), colors.HexColor('#DAEEF3')),
+    ('BACKGROUND', (2, 1), (2, -2), colors.HexColor('#E2EFDA')),
+    ('BACKGROUND', (3, 1), (3, -2), colors.HexColor('#DAEEF3')),
+    ('BACKGROUND', (4, 1), (4, -2), colors.HexColor('#E2EFDA')),
+    
+    ('BACKGROUND', (1, -1), (1, -1), colors.yellow),
+    ('BACKGROUND', (3, -1), (3, -1), colors.yellow),
+    ('BACKGROUND', (2, -1), (2, -1), colors.HexColor('#FFFFCC')),
+    ('BACKGROUND', (4, -1), (4, -1), colors.HexColor('#FFFFCC')),
+    
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+    ('FONTSIZE', (0, 1), (-1, -1), 9),
+    ('ALIGN', (0, 0), (0, -1), 'CENTER'),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+])
+PDF_NET_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (0, 0), colors.yellow),
+    ('BACKGROUND', (1, 0), (1, 0), colors.HexColor('#FFFFCC')),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+    ('FONTNAME', (0, 0), (-1, -1), PDF_FONT_NAME),
+    ('FONTSIZE', (0, 0), (-1, -1), 11),
+    ('TEXTCOLOR', (0, 0), (-1, -1), colors.red),
+    ('ALIGN', (0, 0), (0, 0), 'CENTER'),
+    ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+])
+
+
+def generate_pdf_salary_slip(employee_index, month, year, slips=None):
     """Generate PDF salary slip with Vietnamese support and return as bytes"""
-    df_info = data_store['thong_tin']
-    df_luong = data_store['luong']
+    if slips is None:
+        slips = data_store['slips']
     
-    if employee_index >= len(df_info):
+    if employee_index >= len(slips):
         return None, None
     
-    employee = df_info.iloc[employee_index]
-    name_col = find_employee_name_column(df_info)
-    employee_name = employee[name_col] if name_col else f'NhanVien_{employee_index}'
+    slip_data = slips[employee_index]
+    filename = f"PhieuLuong_{slip_data['ten_file']}_Thang{month}_{year}.pdf"
     
-    salary_row = None
-    if df_luong is not None and name_col:
-        luong_name_col = find_employee_name_column(df_luong)
-        if luong_name_col:
-            salary_match = df_luong[df_luong[luong_name_col].astype(str).str.lower().str.strip() == str(employee_name).lower().strip()]
-            if len(salary_match) > 0:
-                salary_row = salary_match.iloc[0]
-    
-    slip_data = get_salary_slip_data(employee, salary_row, df_info, df_luong)
+    return build_pdf_salary_slip(tuple(slip_data.items()), month, year), filename
+
+
+# Rendering a PDF slip takes milliseconds and the same slip is typically previewed, emailed and
+# bulk-exported in turn; keying on the slip contents keeps re-uploads from serving stale bytes
+@lru_cache(maxsize=256)
+def build_pdf_salary_slip(slip_items, month, year):
+    """Render the PDF salary slip for the given slip data items and return as bytes"""
+    slip_data = dict(slip_items)
     
     output = io.BytesIO()
     doc = SimpleDocTemplate(output, pagesize=A4, topMargin=1*cm, bottomMargin=1*cm, leftMargin=1*cm, rightMargin=1*cm)
     
     elements = []
-    styles = getSampleStyleSheet()
-    
-    # Use Vietnamese font if available
-    font_name = VIETNAMESE_FONT_NAME if VIETNAMESE_FONT_AVAILABLE else 'Helvetica'
-    
-    # Helper function for text - use Vietnamese if font available
-    def vn_text(text):
-        if VIETNAMESE_FONT_AVAILABLE:
-            return str(text)
-        return remove_accents(str(text))
-    
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontName=font_name,
-        fontSize=16,
-        alignment=1,
-        spaceAfter=20,
-        textColor=colors.red
-    )
-    
-    normal_style = ParagraphStyle(
-        'CustomNormal',
-        parent=styles['Normal'],
-        fontName=font_name,
-        fontSize=10
-    )
-    
-    note_style = ParagraphStyle(
-        'CustomNote',
-        parent=styles['Normal'],
-        fontName=font_name,
-        fontSize=8,
-        italic=True
-    )
     
     # Title
     title_text = f"PHIẾU LƯƠNG THÁNG {month} NĂM {year}" if VIETNAMESE_FONT_AVAILABLE else f"PHIEU LUONG THANG {month} NAM {year}"
-    elements.append(Paragraph(title_text, title_style))
+    elements.append(Paragraph(title_text, PDF_TITLE_STYLE))
     elements.append(Spacer(1, 10))
     
     # Info table
+    info_values = [
+        (pdf_text(slip_data['ho_ten']), ''),
+        (format_number(slip_data['luong_thoa_thuan']), ''),
+        ('', ''),
+        (format_number(slip_data['luong_dong']), ''),
+        (slip_data['so_tai_khoan'], pdf_text(slip_data['ten_ngan_hang'])),
+    ]
     info_data = [
-        [vn_text('Họ tên:'), vn_text(slip_data['ho_ten']), vn_text('Ngày công chuẩn:'), ''],
-        [vn_text('Lương thỏa thuận:'), format_number(slip_data['luong_thoa_thuan']), vn_text('Ngày công thực tế:'), ''],
-        [vn_text('% Lương Thử việc:'), '', vn_text('Nghỉ phép:'), ''],
-        [vn_text('Lương đóng:'), format_number(slip_data['luong_dong']), vn_text('Tổng giờ tăng ca:'), ''],
-        [vn_text('Số tài khoản:'), slip_data['so_tai_khoan'], vn_text('Tên ngân hàng:'), vn_text(slip_data['ten_ngan_hang'])],
+        [label, value, second_label, second_value]
+        for (label, second_label), (value, second_value) in zip(PDF_INFO_LABELS, info_values)
     ]
     
-    info_table = Table(info_data, colWidths=[3.5*cm, 5*cm, 4*cm, 5*cm])
-    info_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (0, -1), colors.yellow),
-        ('BACKGROUND', (2, 0), (2, -1), colors.yellow),
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
-        ('FONTNAME', (0, 0), (-1, -1), font_name),
-        ('FONTSIZE', (0, 0), (-1, -1), 9),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-    ]))
+    info_table = Table(info_data, colWidths=PDF_INFO_COL_WIDTHS)
+    info_table.setStyle(PDF_INFO_TABLE_STYLE)
     elements.append(info_table)
     elements.append(Spacer(1, 15))
     
     # Main table
-    table_header = [
-        ['STT', vn_text('Các Khoản Thu Nhập'), '', vn_text('Các Khoản Trừ Vào Lương'), '']
+    item_amounts = [
+        (format_number(slip_data['luong_thuc_te']), format_number(slip_data['bhxh'])),
+        ('', format_number(slip_data['doan_phi'])),
+        ('', format_number(slip_data['thue_tncn'])),
+        ('', ''),
+        ('', ''),
+        ('', ''),
     ]
     
-    table_data = [
-        ['1', vn_text('Lương thực tế'), format_number(slip_data['luong_thuc_te']), 'BHXH', format_number(slip_data['bhxh'])],
-        ['2', vn_text('Phép năm'), '', vn_text('Đoàn phí'), format_number(slip_data['doan_phi'])],
-        ['3', vn_text('Lương tăng ca'), '', vn_text('Thuế Thu Nhập Cá Nhân'), format_number(slip_data['thue_tncn'])],
-        ['4', vn_text('Lương bổ sung'), '', vn_text('Tạm Ứng'), ''],
-        ['5', vn_text('Giữ xe'), '', vn_text('Tiền phạt'), ''],
-        ['6', vn_text('Công tác phí'), '', vn_text('Khác'), ''],
-    ]
+    full_table_data = [list(PDF_TABLE_HEADER)]
+    for (stt, income_label, deduction_label), (income, deduction) in zip(PDF_ITEM_LABELS, item_amounts):
+        full_table_data.append([stt, income_label, income, deduction_label, deduction])
+    full_table_data.append(['', PDF_TOTAL_INCOME_LABEL, format_number(slip_data['tong_thu_nhap']),
+                            PDF_TOTAL_DEDUCTION_LABEL, format_number(slip_data['tong_khoan_tru'])])
     
-    totals_data = [
-        ['', vn_text('Tổng Cộng Thu Nhập'), format_number(slip_data['tong_thu_nhap']), 
-         vn_text('Tổng Cộng Khoản Trừ'), format_number(slip_data['tong_khoan_tru'])],
-    ]
-    
-    full_table_data = table_header + table_data + totals_data
-    
-    main_table = Table(full_table_data, colWidths=[1.5*cm, 4.5*cm, 3.5*cm, 4.5*cm, 3.5*cm])
-    main_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#FFC000')),
-        ('SPAN', (1, 0), (2, 0)),
-        ('SPAN', (3, 0), (4, 0)),
-        ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, -1), font_name),
-        ('FONTSIZE', (0, 0), (-1, 0), 10),
-        
-        ('BACKGROUND', (0, 1), (0, -2), colors.HexColor('#DAEEF3')),
-        ('BACKGROUND', (1, 1), (1, -2), colors.HexColor('#DAEEF3')),
-        ('BACKGROUND', (2, 1), (2, -2), colors.HexColor('#E2EFDA')),
-        ('BACKGROUND', (3, 1), (3, -2), colors.HexColor('#DAEEF3')),
-        ('BACKGROUND', (4, 1), (4, -2), colors.HexColor('#E2EFDA')),
-        
-        ('BACKGROUND', (1, -1), (1, -1), colors.yellow),
-        ('BACKGROUND', (3, -1), (3, -1), colors.yellow),
-        ('BACKGROUND', (2, -1), (2, -1), colors.HexColor('#FFFFCC')),
-        ('BACKGROUND', (4, -1), (4, -1), colors.HexColor('#FFFFCC')),
-        
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
-        ('FONTSIZE', (0, 1), (-1, -1), 9),
-        ('ALIGN', (0, 0), (0, -1), 'CENTER'),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-    ]))
+    main_table = Table(full_table_data, colWidths=PDF_MAIN_COL_WIDTHS)
+    main_table.setStyle(PDF_MAIN_TABLE_STYLE)
     elements.append(main_table)
     elements.append(Spacer(1, 5))
     
     # Net salary row
-    net_data = [[vn_text('Tổng Số Tiền Lương Thực Nhận'), format_number(slip_data['luong_thuc_nhan'])]]
-    net_table = Table(net_data, colWidths=[14*cm, 3.5*cm])
-    net_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (0, 0), colors.yellow),
-        ('BACKGROUND', (1, 0), (1, 0), colors.HexColor('#FFFFCC')),
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
-        ('FONTNAME', (0, 0), (-1, -1), font_name),
-        ('FONTSIZE', (0, 0), (-1, -1), 11),
-        ('TEXTCOLOR', (0, 0), (-1, -1), colors.red),
-        ('ALIGN', (0, 0), (0, 0), 'CENTER'),
-        ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-    ]))
+    net_data = [[PDF_NET_LABEL, format_number(slip_data['luong_thuc_nhan'])]]
+    net_table = Table(net_data, colWidths=PDF_NET_COL_WIDTHS)
+    net_table.setStyle(PDF_NET_TABLE_STYLE)
     elements.append(net_table)
     
     # Footer note
     elements.append(Spacer(1, 20))
-    elements.append(Paragraph(vn_text("Anh/Chị vui lòng kiểm tra lại thông tin trên phiếu lương. Mọi thắc mắc vui lòng liên hệ Phòng HCNS trong vòng"), note_style))
-    elements.append(Paragraph(vn_text("24 giờ (kể từ thời điểm nhận được thông báo này) để được giải quyết."), note_style))
-    elements.append(Paragraph(vn_text("Quá thời hạn trên, thông tin trên phiếu lương sẽ được xem là chính xác và không có khiếu nại. Trân trọng cảm ơn!"), note_style))
+    for note in PDF_NOTES:
+        elements.append(Paragraph(note, PDF_NOTE_STYLE))
     
     doc.build(elements)
-    output.seek(0)
     
-    safe_name = "".join(c for c in str(employee_name) if c.isalnum() or c in (' ', '_')).strip()
-    filename = f"PhieuLuong_{safe_name}_Thang{month}_{year}.pdf"
+    return output.getvalue()
+
+
+def resolve_period(month, year):
+    """Fill in the current month/year for whichever of the two the client did not send"""
+    # Compared against None so an explicit 0 is kept, and the clock is only read when needed
+    if month is None or year is None:
+        now = datetime.now()
+        month = now.month if month is None else month
+        year = now.year if year is None else year
+    return month, year
+
+
+def slip_etag(file_type, employee_index, month, year):
+    """ETag of an exported salary slip, tied to the upload it was generated from"""
+    return f"{file_type}-{data_store['upload_id']}-{employee_index}-{month}-{year}"
+
+
+def not_modified(etag):
+    """Build an empty 304 response for a slip the client already has"""
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+# Bulk PDF exports of at least this many slips are rendered in a process pool;
+# below that (and for template-based Excel slips) starting the workers costs more than it saves
+BULK_EXPORT_PARALLEL_MIN = 20
+# Upper bound on bulk export worker processes, which each hold a copy of the slips and the fonts
+BULK_EXPORT_MAX_WORKERS = 4
+
+# data_store entries the slip generators read, snapshotted for bulk exports and handed to their workers
+EXPORT_DATA_KEYS = ('slips',)
+
+
+def export_worker_count():
+    """Number of worker processes for a bulk export: the CPUs this process may use, capped"""
+    try:
+        cpus = len(os.sched_getaffinity(0))  # Honours container CPU pinning, unlike os.cpu_count()
+    except AttributeError:  # Not available on Windows and macOS
+        cpus = os.cpu_count() or 1
+    return min(cpus, BULK_EXPORT_MAX_WORKERS)
+
+
+def take_export_snapshot():
+    """Copy the data_store entries a bulk export renders from, all from the same upload"""
+    with data_store_lock:
+        return {key: data_store[key] for key in EXPORT_DATA_KEYS}
+
+
+def init_export_worker(snapshot):
+    """Load the uploaded data into a bulk export worker process"""
+    data_store.update(snapshot)
+
+
+def render_salary_slip(job, slips=None):
+    """Render one salary slip of a bulk export and return (file_data, filename)"""
+    # Pool workers pass no slips and read the snapshot init_export_worker loaded into their data_store
+    idx, file_type, month, year = job
+    if file_type == 'excel':
+        return generate_excel_salary_slip(idx, month, year, slips)
+    return generate_pdf_salary_slip(idx, month, year, slips)
+
+
+def render_salary_slips(jobs, file_type, snapshot):
+    """Render the slips of a bulk export in order from a take_export_snapshot() snapshot,
+    in a process pool when there are enough of them"""
+    # Rendering from the snapshot rather than data_store keeps a bulk export that is still streaming
+    # (or a bulk email job still sending) on the upload it started from if a new file is uploaded
+    workers = export_worker_count()
+    if file_type == 'excel' or len(jobs) < BULK_EXPORT_PARALLEL_MIN or workers == 1:
+        for job in jobs:
+            yield render_salary_slip(job, snapshot['slips'])
+        return
     
-    return output.getvalue(), filename
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=init_export_worker, initargs=(snapshot,))
+    try:
+        chunksize = max(1, len(jobs) // (workers * 4))
+        yield from executor.map(render_salary_slip, jobs, chunksize=chunksize)
+    finally:
+        # When the client disconnects the generator is closed here; drop the slips not started yet
+        # instead of waiting for the whole batch like the executor's context manager would
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ZipChunkWriter(io.RawIOBase):
+    """Unseekable sink for zipfile that hands back what was written since the last call"""
+    
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(files):
+    """Yield a zip archive of (file_data, filename) pairs chunk by chunk"""
+    # zipfile writes data descriptors instead of seeking back when the sink is unseekable
+    sink = ZipChunkWriter()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for file_data, filename in files:
+            if file_data:
+                # PDF streams and Excel slip parts are already deflated, compressing them again saves little
+                compress_type = zipfile.ZIP_STORED if filename.endswith(('.pdf', '.xlsx')) else zipfile.ZIP_DEFLATED
+                zip_file.writestr(filename, file_data, compress_type=compress_type)
+                yield sink.take()
+    yield sink.take()
+
+
+EMAIL_ATTACHMENT_TYPES = {
+    '.pdf': ('application', 'pdf'),
+    '.xlsx': ('application', 'vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
 
 
-def send_email_with_attachment(to_email, subject, body, attachment_data, attachment_filename):
+def open_smtp_connection():
+    """Open an SMTP connection logged in with the configured sender account"""
+    server = smtplib.SMTP(EMAIL_CONFIG['smtp_server'], EMAIL_CONFIG['smtp_port'])
+    server.starttls()
+    server.login(EMAIL_CONFIG['sender_email'], EMAIL_CONFIG['sender_password'])
+    return server
+
+
+def send_with_smtp_session(smtp_session, msg):
+    """Send a message over the session's shared connection, reconnecting once if the server dropped it"""
+    server = smtp_session.get('server')
+    if server is not None and time.monotonic() - smtp_session['last_used'] > SMTP_IDLE_CHECK_SECONDS:
+        try:
+            server.noop()
+        except (smtplib.SMTPException, OSError):
+            server = None
+    if server is None:
+        server = smtp_session['server'] = open_smtp_connection()
+        # Set on connect too: a send that raises below must not leave the session without it
+        smtp_session['last_used'] = time.monotonic()
+    try:
+        server.send_message(msg)
+    except (smtplib.SMTPServerDisconnected, ConnectionError):
+        smtp_session['server'] = open_smtp_connection()
+        smtp_session['server'].send_message(msg)
+    smtp_session['last_used'] = time.monotonic()
+
+
+def close_smtp_session(smtp_session):
+    """Log out of the session's shared SMTP connection, if one was opened"""
+    server = smtp_session.pop('server', None)
+    if server is not None:
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+
+atexit.register(close_smtp_session, smtp_shared_session)
+
+
+def send_email_with_attachment(to_email, subject, body, attachment_data, attachment_filename, smtp_session=None):
     """Send email with attachment using SMTP"""
-    from email.header import Header
-    from email.utils import encode_rfc2231
-    import unicodedata
-    
+    # smtp_session is a dict shared across calls (see send_with_smtp_session) so a batch of emails
+    # pays for the connection, TLS handshake and login once; without it each email connects on its own
     if not EMAIL_CONFIG['sender_email'] or not EMAIL_CONFIG['sender_password']:
         return False, "Chưa cấu hình email gửi. Vui lòng cấu hình SMTP_SERVER, SENDER_EMAIL, SENDER_PASSWORD."
     
     try:
-        msg = MIMEMultipart()
+        msg = EmailMessage()
         msg['From'] = EMAIL_CONFIG['sender_email']
         msg['To'] = to_email
-        msg['Subject'] = Header(subject, 'utf-8')
-        
-        msg.attach(MIMEText(body, 'plain', 'utf-8'))
+        msg['Subject'] = subject
+        msg.set_content(body, cte='base64')
         
         # Determine MIME type based on file extension
-        if attachment_filename.lower().endswith('.pdf'):
-            mime_type = 'application/pdf'
-        elif attachment_filename.lower().endswith('.xlsx'):
-            mime_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        else:
-            mime_type = 'application/octet-stream'
-        
-        main_type, sub_type = mime_type.split('/', 1)
-        attachment = MIMEBase(main_type, sub_type)
-        attachment.set_payload(attachment_data)
-        encoders.encode_base64(attachment)
-        
-        # Properly encode filename for Vietnamese characters using RFC 2231
-        # Create ASCII-safe filename for Content-Disposition
-        ascii_filename = unicodedata.normalize('NFKD', attachment_filename).encode('ascii', 'ignore').decode('ascii')
-        if not ascii_filename:
-            ascii_filename = 'PhieuLuong' + ('.pdf' if '.pdf' in attachment_filename else '.xlsx')
-        
-        # Use RFC 2231 encoding for the actual filename with Vietnamese
-        attachment.add_header(
-            'Content-Disposition', 
-            'attachment',
-            filename=('utf-8', '', attachment_filename)
-        )
-        msg.attach(attachment)
+        extension = os.path.splitext(attachment_filename)[1].lower()
+        main_type, sub_type = EMAIL_ATTACHMENT_TYPES.get(extension, ('application', 'octet-stream'))
         
-        server = smtplib.SMTP(EMAIL_CONFIG['smtp_server'], EMAIL_CONFIG['smtp_port'])
-        server.starttls()
-        server.login(EMAIL_CONFIG['sender_email'], EMAIL_CONFIG['sender_password'])
-        server.send_message(msg)
-        server.quit()
+        # The default email policy encodes the Vietnamese subject and filename (RFC 2047 / RFC 2231)
+        # and base64-encodes the attachment in one pass
+        msg.add_attachment(attachment_data, maintype=main_type, subtype=sub_type, filename=attachment_filename)
+        
+        if smtp_session is None:
+            server = open_smtp_connection()
+            server.send_message(msg)
+            server.quit()
+        else:
+            send_with_smtp_session(smtp_session, msg)
         
         return True, "Email đã gửi thành công!"
     except Exception as e:
@@ -859,6 +1151,12 @@ def index():
                          email_configured=email_configured)
 
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    """Reject uploads over MAX_UPLOAD_BYTES before they are read"""
+    return jsonify({'success': False, 'error': f'File quá lớn. Dung lượng tối đa là {MAX_UPLOAD_BYTES // (1024 * 1024)} MB.'}), 413
+
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """Handle file upload"""
@@ -874,22 +1172,53 @@ def upload_file():
         return jsonify({'success': False, 'error': 'Chỉ hỗ trợ file Excel (.xlsx, .xls)'})
     
     try:
-        xlsx = pd.ExcelFile(file)
-        
-        for sheet_name in xlsx.sheet_names:
-            df = pd.read_excel(xlsx, sheet_name=sheet_name, header=None)
+        xlsx = pd.ExcelFile(file, engine=EXCEL_READ_ENGINE)
+        
+        # Only parse the sheets we use, all through the one open workbook
+        wanted_sheets = [name for name in xlsx.sheet_names if is_info_sheet(name) or is_salary_sheet(name)]
+        # Read at most one row past the limit (with headers), so an oversized sheet is never fully loaded
+        sheets = pd.read_excel(xlsx, sheet_name=wanted_sheets, header=None,
+                               nrows=MAX_UPLOAD_ROWS + MAX_UPLOAD_HEADER_ROWS + 1) if wanted_sheets else {}
+        
+        # Build the new state first and swap it in with one update, so a failed upload leaves the
+        # previous data intact and the swap itself is short (readers are not locked out, see data_store_lock)
+        updates = {}
+        for sheet_name, df in sheets.items():
             df_cleaned = clean_dataframe(df, sheet_name)
             
-            if 'thông tin' in sheet_name.lower() or 'thong tin' in sheet_name.lower():
-                data_store['thong_tin'] = df_cleaned
-                data_store['columns_thong_tin'] = [col for col in df_cleaned.columns if is_valid_column(col)]
-                data_store['employees_list'] = get_employees_list(df_cleaned)
-            elif 'lương' in sheet_name.lower() or 'luong' in sheet_name.lower():
-                data_store['luong'] = df_cleaned
-                data_store['columns_luong'] = [col for col in df_cleaned.columns if is_valid_column(col)]
+            # A read that reached nrows was cut short, so the sheet is over the limit whatever remains after cleaning
+            if len(df_cleaned) > MAX_UPLOAD_ROWS or len(df) > MAX_UPLOAD_ROWS + MAX_UPLOAD_HEADER_ROWS:
+                return jsonify({'success': False, 'error': f'Sheet "{sheet_name}" vượt quá giới hạn {MAX_UPLOAD_ROWS} dòng dữ liệu. Vui lòng chia nhỏ file.'})
+            
+            if is_info_sheet(sheet_name):
+                updates['thong_tin'] = df_cleaned
+                updates['columns_thong_tin'] = [col for col in df_cleaned.columns if is_valid_column(col)]
+                updates['name_col'] = find_employee_name_column(df_cleaned)
+                updates['email_col'] = find_employee_email_column(df_cleaned)
+                updates['search_text'] = build_search_text(df_cleaned, updates['columns_thong_tin'])
+                updates['search_index'] = build_search_index(updates['search_text'])
+                updates['employees_list'] = get_employees_list(df_cleaned)
+                updates['info_col_map'] = build_info_column_map(df_cleaned)
+            elif is_salary_sheet(sheet_name):
+                updates['luong'] = df_cleaned
+                updates['luong_name_index'] = build_salary_name_index(df_cleaned)
+                updates['slip_col_map'] = build_slip_column_map(df_cleaned)
+                updates['columns_luong'] = [col for col in df_cleaned.columns if is_valid_column(col)]
+        
+        # Slips depend on both sheets, so combine this upload with whatever sheet is already loaded
+        current = {**data_store, **updates}
+        if current['thong_tin'] is not None:
+            updates['slips'] = build_salary_slips(current['thong_tin'], current['luong'], current['info_col_map'],
+                                                  current['slip_col_map'], current['luong_name_index'])
         
         # Reset email status on new upload
-        data_store['email_status'] = {}
+        updates['email_status'] = {}
+        
+        # A fresh id per upload (not a counter) so ETags never repeat across server restarts
+        updates['upload_id'] = uuid.uuid4().hex
+        
+        with data_store_lock:
+            data_store.update(updates)
         
         return jsonify({
             'success': True,
@@ -901,7 +1230,6 @@ def upload_file():
         })
     
     except Exception as e:
-        import traceback
         return jsonify({'success': False, 'error': f'Lỗi xử lý file: {str(e)}'})
 
 
@@ -918,8 +1246,8 @@ def get_employee(employee_index):
         return jsonify({'success': False, 'error': 'Không tìm thấy nhân viên'})
     
     employee = df_info.iloc[employee_index]
-    name_col = find_employee_name_column(df_info)
-    email_col = find_employee_email_column(df_info)
+    name_col = data_store['name_col']
+    email_col = data_store['email_col']
     
     employee_data = {
         'index': employee_index,
@@ -933,24 +1261,13 @@ def get_employee(employee_index):
         if pd.notna(email) and '@' in str(email):
             employee_data['email'] = str(email).strip()
     
-    for col in df_info.columns:
-        if is_valid_column(col):
-            val = employee[col]
-            if pd.notna(val):
-                employee_data['info'][col] = str(val)
+    employee_data['info'] = row_to_dict(employee, data_store['columns_thong_tin'])
     
     if df_luong is not None and name_col:
         employee_name = employee[name_col]
-        luong_name_col = find_employee_name_column(df_luong)
-        if luong_name_col and pd.notna(employee_name):
-            salary_match = df_luong[df_luong[luong_name_col].astype(str).str.lower().str.strip() == str(employee_name).lower().strip()]
-            if len(salary_match) > 0:
-                employee_data['salary'] = {}
-                for col in df_luong.columns:
-                    if is_valid_column(col):
-                        val = salary_match.iloc[0][col]
-                        if pd.notna(val):
-                            employee_data['salary'][col] = str(val)
+        salary_row = find_salary_row(employee_name) if pd.notna(employee_name) else None
+        if salary_row is not None:
+            employee_data['salary'] = row_to_dict(salary_row, data_store['columns_luong'])
     
     return jsonify({
         'success': True,
@@ -973,20 +1290,30 @@ def search_employee():
     df_info = data_store['thong_tin']
     df_luong = data_store['luong']
     
-    mask = pd.Series([False] * len(df_info))
+    search_text = data_store['search_text']
+    needle = search_term.lower()
     
-    for col in df_info.columns:
-        if is_valid_column(col):
-            mask = mask | df_info[col].astype(str).str.lower().str.contains(search_term.lower(), na=False)
+    # Narrow down to rows containing every trigram of the term, then verify those rows
+    if len(needle) >= 3:
+        index = data_store['search_index']
+        trigram_rows = [index.get(needle[i:i + 3], EMPTY_POSTINGS) for i in range(len(needle) - 2)]
+        trigram_rows.sort(key=len)
+        candidates = trigram_rows[0]
+        for rows in trigram_rows[1:]:
+            candidates = np.intersect1d(candidates, rows, assume_unique=True)
+        search_text = search_text.iloc[candidates]
     
-    results = df_info[mask]
+    # One scan of the joined row text instead of one per column
+    mask = search_text.str.contains(needle, regex=False, na=False).to_numpy()
+    
+    results = df_info.loc[search_text.index[mask]]
     
     if len(results) == 0:
         return jsonify({'success': False, 'error': 'Không tìm thấy kết quả'})
     
     results_list = []
-    name_col = find_employee_name_column(df_info)
-    email_col = find_employee_email_column(df_info)
+    name_col = data_store['name_col']
+    email_col = data_store['email_col']
     
     for idx, row in results.iterrows():
         employee_data = {
@@ -1001,24 +1328,13 @@ def search_employee():
             if pd.notna(email) and '@' in str(email):
                 employee_data['email'] = str(email).strip()
         
-        for col in df_info.columns:
-            if is_valid_column(col):
-                val = row[col]
-                if pd.notna(val):
-                    employee_data['info'][col] = str(val)
+        employee_data['info'] = row_to_dict(row, data_store['columns_thong_tin'])
         
         if df_luong is not None and name_col:
             employee_name = row[name_col]
-            luong_name_col = find_employee_name_column(df_luong)
-            if luong_name_col and pd.notna(employee_name):
-                salary_match = df_luong[df_luong[luong_name_col].astype(str).str.lower().str.strip() == str(employee_name).lower().strip()]
-                if len(salary_match) > 0:
-                    employee_data['salary'] = {}
-                    for col in df_luong.columns:
-                        if is_valid_column(col):
-                            val = salary_match.iloc[0][col]
-                            if pd.notna(val):
-                                employee_data['salary'][col] = str(val)
+            salary_row = find_salary_row(employee_name) if pd.notna(employee_name) else None
+            if salary_row is not None:
+                employee_data['salary'] = row_to_dict(salary_row, data_store['columns_luong'])
         
         results_list.append(employee_data)
     
@@ -1036,9 +1352,13 @@ def export_excel(employee_index):
         return jsonify({'success': False, 'error': 'Không có dữ liệu'})
     
     try:
-        now = datetime.now()
-        month = request.args.get('month', now.month, type=int)
-        year = request.args.get('year', now.year, type=int)
+        # Only fall back to the clock when the query string leaves month/year out
+        month, year = resolve_period(request.args.get('month', type=int), request.args.get('year', type=int))
+        
+        # Slips only change with a new upload, so a client holding this one gets a 304 without regenerating
+        etag = slip_etag('excel', employee_index, month, year)
+        if request.if_none_match.contains(etag):
+            return not_modified(etag)
         
         file_data, filename = generate_excel_salary_slip(employee_index, month, year)
         
@@ -1049,11 +1369,11 @@ def export_excel(employee_index):
             io.BytesIO(file_data),
             mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
             as_attachment=True,
-            download_name=filename
+            download_name=filename,
+            etag=etag
         )
     
     except Exception as e:
-        import traceback
         return jsonify({'success': False, 'error': str(e)})
 
 
@@ -1064,9 +1384,13 @@ def export_pdf(employee_index):
         return jsonify({'success': False, 'error': 'Không có dữ liệu'})
     
     try:
-        now = datetime.now()
-        month = request.args.get('month', now.month, type=int)
-        year = request.args.get('year', now.year, type=int)
+        # Only fall back to the clock when the query string leaves month/year out
+        month, year = resolve_period(request.args.get('month', type=int), request.args.get('year', type=int))
+        
+        # Slips only change with a new upload, so a client holding this one gets a 304 without regenerating
+        etag = slip_etag('pdf', employee_index, month, year)
+        if request.if_none_match.contains(etag):
+            return not_modified(etag)
         
         file_data, filename = generate_pdf_salary_slip(employee_index, month, year)
         
@@ -1077,11 +1401,11 @@ def export_pdf(employee_index):
             io.BytesIO(file_data),
             mimetype='application/pdf',
             as_attachment=True,
-            download_name=filename
+            download_name=filename,
+            etag=etag
         )
     
     except Exception as e:
-        import traceback
         return jsonify({'success': False, 'error': str(e)})
 
 
@@ -1095,42 +1419,26 @@ def export_bulk():
         data = request.get_json()
         indices = data.get('indices', [])  # List of employee indices, or 'all'
         file_type = data.get('file_type', 'pdf')  # 'pdf' or 'excel'
-        month = data.get('month', datetime.now().month)
-        year = data.get('year', datetime.now().year)
+        month, year = resolve_period(data.get('month'), data.get('year'))
         
-        df_info = data_store['thong_tin']
+        snapshot = take_export_snapshot()
+        employee_count = len(snapshot['slips'])  # One slip per 'thong_tin' row
         
         # Handle 'all' selection
         if indices == 'all' or not indices:
-            indices = list(range(len(df_info)))
-        
-        # Create zip file in memory
-        zip_buffer = io.BytesIO()
+            indices = list(range(employee_count))
         
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for idx in indices:
-                if idx < len(df_info):
-                    if file_type == 'excel':
-                        file_data, filename = generate_excel_salary_slip(idx, month, year)
-                    else:
-                        file_data, filename = generate_pdf_salary_slip(idx, month, year)
-                    
-                    if file_data:
-                        zip_file.writestr(filename, file_data)
-        
-        zip_buffer.seek(0)
+        jobs = [(idx, file_type, month, year) for idx in indices if idx < employee_count]
         
         zip_filename = f"PhieuLuong_Thang{month}_{year}.zip"
         
-        return send_file(
-            zip_buffer,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name=zip_filename
-        )
+        # Stream the zip out as slips are rendered: the first bytes leave right away and
+        # only one slip plus the compressor state is held in memory
+        response = app.response_class(stream_zip(render_salary_slips(jobs, file_type, snapshot)), mimetype='application/zip')
+        response.headers.set('Content-Disposition', 'attachment', filename=zip_filename)
+        return response
     
     except Exception as e:
-        import traceback
         return jsonify({'success': False, 'error': str(e)})
 
 
@@ -1142,8 +1450,7 @@ def send_email(employee_index):
     
     try:
         data = request.get_json()
-        month = data.get('month', datetime.now().month)
-        year = data.get('year', datetime.now().year)
+        month, year = resolve_period(data.get('month'), data.get('year'))
         file_type = data.get('file_type', 'pdf')
         
         df_info = data_store['thong_tin']
@@ -1152,8 +1459,8 @@ def send_email(employee_index):
             return jsonify({'success': False, 'error': 'Không tìm thấy nhân viên'})
         
         employee = df_info.iloc[employee_index]
-        name_col = find_employee_name_column(df_info)
-        email_col = find_employee_email_column(df_info)
+        name_col = data_store['name_col']
+        email_col = data_store['email_col']
         
         if not email_col or email_col not in employee.index:
             return jsonify({'success': False, 'error': 'Không tìm thấy cột email trong dữ liệu'})
@@ -1185,7 +1492,9 @@ Anh/Chị vui lòng kiểm tra lại thông tin trên phiếu lương. Mọi th
 Trân trọng!"""
         
         # Send email
-        success, message = send_email_with_attachment(to_email, subject, body, file_data, filename)
+        with smtp_shared_lock:
+            success, message = send_email_with_attachment(to_email, subject, body, file_data, filename,
+                                                          smtp_session=smtp_shared_session)
         
         # Update status
         data_store['email_status'][employee_index] = {
@@ -1204,7 +1513,6 @@ Trân trọng!"""
         })
     
     except Exception as e:
-        import traceback
         data_store['email_status'][employee_index] = {
             'sent': True,
             'success': False,
@@ -1214,116 +1522,166 @@ Trân trọng!"""
         return jsonify({'success': False, 'error': str(e)})
 
 
+# Bulk email jobs by id, filled in by run_email_bulk_job and polled through /email_status
+email_jobs = {}
+EMAIL_JOBS_KEPT = 20  # Finished jobs kept for polling before the oldest are dropped
+
+
+def run_email_bulk_job(job, recipients, file_type, month, year, snapshot, email_status):
+    """Send the slips of a bulk email job, recording each result on the job as it goes"""
+    # snapshot and email_status were taken from data_store with the recipients, so a file uploaded
+    # while the job runs neither changes the slips sent nor receives this job's statuses
+    try:
+        # Slips render in a process pool for large PDF batches (see render_salary_slips) while this loop sends
+        jobs = [(idx, file_type, month, year) for idx, _, to_email, _ in recipients if to_email]
+        slips = render_salary_slips(jobs, file_type, snapshot)
+        
+        for idx, employee_name, to_email, error in recipients:
+            if error:
+                job['fail_count'] += 1
+                email_status[idx] = {
+                    'sent': True, 'success': False, 
+                    'message': error, 
+                    'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                }
+                job['results'].append({'index': idx, 'name': employee_name, 'success': False, 'message': error})
+                continue
+            
+            file_data, filename = next(slips)
+            
+            if not file_data:
+                job['fail_count'] += 1
+                job['results'].append({'index': idx, 'name': employee_name, 'success': False, 'message': 'Không thể tạo file'})
+                continue
+            
+            # Send email
+            subject = f"Phiếu lương tháng {month}/{year}"
+            body = f"""Xin chào {employee_name},
+
+Phiếu lương tháng {month}/{year} được đính kèm bên dưới.
+
+Anh/Chị vui lòng kiểm tra lại thông tin trên phiếu lương. Mọi thắc mắc vui lòng liên hệ Phòng HCNS trong vòng 24 giờ để được giải quyết.
+
+Trân trọng!"""
+            
+            # The batch shares one SMTP connection, instead of a new TLS handshake and login per email.
+            # The lock is taken per message so single sends and /configure_email are not held up for the batch
+            with smtp_shared_lock:
+                success, message = send_email_with_attachment(to_email, subject, body, file_data, filename,
+                                                              smtp_session=smtp_shared_session)
+            
+            email_status[idx] = {
+                'sent': True, 'success': success, 
+                'message': message, 
+                'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'month': month, 'year': year
+            }
+            
+            if success:
+                job['success_count'] += 1
+            else:
+                job['fail_count'] += 1
+            
+            job['results'].append({'index': idx, 'name': employee_name, 'success': success, 'message': message})
+        
+        job['message'] = f"Đã gửi {job['success_count']} email thành công, {job['fail_count']} thất bại"
+    except Exception as e:
+        job['error'] = str(e)
+    finally:
+        job['done'] = True
+
+
 @app.route('/send_email_bulk', methods=['POST'])
 def send_email_bulk():
-    """Send salary slips to multiple employees"""
+    """Start sending salary slips to multiple employees in the background"""
     if data_store['thong_tin'] is None:
         return jsonify({'success': False, 'error': 'Không có dữ liệu'})
     
     try:
         data = request.get_json()
         indices = data.get('indices', [])
-        month = data.get('month', datetime.now().month)
-        year = data.get('year', datetime.now().year)
+        month, year = resolve_period(data.get('month'), data.get('year'))
         file_type = data.get('file_type', 'pdf')
         
-        df_info = data_store['thong_tin']
+        # Everything the job reads or writes comes from one upload, taken together
+        with data_store_lock:
+            df_info = data_store['thong_tin']
+            name_col = data_store['name_col']
+            email_col = data_store['email_col']
+            email_status = data_store['email_status']
+            snapshot = {key: data_store[key] for key in EXPORT_DATA_KEYS}
         
         if indices == 'all' or not indices:
             indices = list(range(len(df_info)))
         
-        results = []
-        success_count = 0
-        fail_count = 0
+        # Check the recipients first so the slips of the valid ones can be rendered ahead of the sends
         
+        # Pull the two columns out once instead of building a row Series per recipient
+        names = df_info[name_col].to_numpy() if name_col else None
+        emails = df_info[email_col].to_numpy() if email_col else None
+        if email_col:
+            email_values = df_info[email_col]
+            valid_emails = (email_values.notna() & email_values.astype(str).str.contains('@', regex=False)).to_numpy()
+        
+        recipients = []  # (index, name, email, error)
         for idx in indices:
             if idx < len(df_info):
-                employee = df_info.iloc[idx]
-                name_col = find_employee_name_column(df_info)
-                email_col = find_employee_email_column(df_info)
-                
-                employee_name = employee[name_col] if name_col else f'NV {idx}'
+                employee_name = names[idx] if name_col else f'NV {idx}'
                 
-                if not email_col or email_col not in employee.index:
-                    fail_count += 1
-                    data_store['email_status'][idx] = {
-                        'sent': True, 'success': False, 
-                        'message': 'Không có email', 
-                        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    }
-                    results.append({'index': idx, 'name': employee_name, 'success': False, 'message': 'Không có email'})
+                if not email_col:
+                    recipients.append((idx, employee_name, None, 'Không có email'))
                     continue
                 
-                to_email = employee[email_col]
-                if not pd.notna(to_email) or '@' not in str(to_email):
-                    fail_count += 1
-                    data_store['email_status'][idx] = {
-                        'sent': True, 'success': False, 
-                        'message': 'Email không hợp lệ', 
-                        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    }
-                    results.append({'index': idx, 'name': employee_name, 'success': False, 'message': 'Email không hợp lệ'})
-                    continue
-                
-                to_email = str(to_email).strip()
-                
-                # Generate file
-                if file_type == 'excel':
-                    file_data, filename = generate_excel_salary_slip(idx, month, year)
-                else:
-                    file_data, filename = generate_pdf_salary_slip(idx, month, year)
-                
-                if not file_data:
-                    fail_count += 1
-                    results.append({'index': idx, 'name': employee_name, 'success': False, 'message': 'Không thể tạo file'})
+                if not valid_emails[idx]:
+                    recipients.append((idx, employee_name, None, 'Email không hợp lệ'))
                     continue
                 
-                # Send email
-                subject = f"Phiếu lương tháng {month}/{year}"
-                body = f"""Xin chào {employee_name},
-
-Phiếu lương tháng {month}/{year} được đính kèm bên dưới.
-
-Anh/Chị vui lòng kiểm tra lại thông tin trên phiếu lương. Mọi thắc mắc vui lòng liên hệ Phòng HCNS trong vòng 24 giờ để được giải quyết.
-
-Trân trọng!"""
-                
-                success, message = send_email_with_attachment(to_email, subject, body, file_data, filename)
-                
-                data_store['email_status'][idx] = {
-                    'sent': True, 'success': success, 
-                    'message': message, 
-                    'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'month': month, 'year': year
-                }
-                
-                if success:
-                    success_count += 1
-                else:
-                    fail_count += 1
-                
-                results.append({'index': idx, 'name': employee_name, 'success': success, 'message': message})
+                recipients.append((idx, employee_name, str(emails[idx]).strip(), None))
+        
+        # Sending takes seconds per email, longer than a request may stay open behind gunicorn or a
+        # proxy, so it runs on a background thread and the page polls /email_status?job_id=...
+        finished = [job_id for job_id, job in email_jobs.items() if job['done']]
+        for job_id in finished[:max(0, len(finished) - EMAIL_JOBS_KEPT + 1)]:
+            del email_jobs[job_id]
+        
+        job_id = uuid.uuid4().hex
+        job = email_jobs[job_id] = {
+            'done': False,
+            'total': len(recipients),
+            'results': [],
+            'success_count': 0,
+            'fail_count': 0,
+            'message': ''
+        }
+        threading.Thread(target=run_email_bulk_job, args=(job, recipients, file_type, month, year,
+                                                             snapshot, email_status),
+                         daemon=True).start()
         
         return jsonify({
             'success': True,
-            'message': f'Đã gửi {success_count} email thành công, {fail_count} thất bại',
-            'results': results,
-            'success_count': success_count,
-            'fail_count': fail_count
+            'job_id': job_id,
+            'total': len(recipients),
+            'message': f'Đang gửi {len(recipients)} email'
         })
     
     except Exception as e:
-        import traceback
         return jsonify({'success': False, 'error': str(e)})
 
 
 @app.route('/email_status')
 def get_email_status():
-    """Get email status for all employees"""
-    return jsonify({
+    """Get email status for all employees, and the progress of a bulk email job if one is given"""
+    response = {
         'success': True,
-        'email_status': data_store['email_status']
-    })
+        'email_status': dict(data_store['email_status'])
+    }
+    
+    job_id = request.args.get('job_id')
+    if job_id:
+        job = email_jobs.get(job_id)
+        response['job'] = dict(job, results=list(job['results'])) if job else None
+    
+    return jsonify(response)
 
 
 @app.route('/configure_email', methods=['POST'])
@@ -1341,6 +1699,10 @@ def configure_email():
         if 'sender_password' in data:
             EMAIL_CONFIG['sender_password'] = data['sender_password']
         
+        # The open connection is logged in with the old settings
+        with smtp_shared_lock:
+            close_smtp_session(smtp_shared_session)
+        
         return jsonify({
             'success': True,
             'message': 'Cấu hình email đã được cập nhật',